@@ -1,300 +1,648 @@
+import os
+import signal
 import sys
-import json
 from typing import Any, Dict, Tuple
 import subprocess
+import tempfile
+import itertools
+import functools
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+import ijson
+import orjson
 from ortools.sat.python import cp_model
 
-def quantity_bounds(q: Dict[str, Any]) -> Tuple[int, int]:
+INT_MIN = cp_model.INT_MIN
+INT_MAX = cp_model.INT_MAX
+
+@functools.lru_cache(maxsize=None)
+def q_bounds_cached(key: Tuple) -> Tuple[int, int]:
+    """key is ("S", n) or ("M", from, to)"""
+    if key[0] == "S":
+        n = int(key[1])
+        return n, n
+    return int(key[1]), int(key[2])
+
+
+def q_bounds(q: Dict[str, Any]) -> Tuple[int, int]:
     """
     q is like {"Single": 1} or {"Many": {"from": 2, "to": 4}}
     Returns (min, max)
     """
     if "Single" in q:
-        n = int(q["Single"])
-        return n, n
+        return q_bounds_cached(("S", q["Single"]))
     many = q["Many"]
-    return int(many["from"]), int(many["to"])
+    return q_bounds_cached(("M", many["from"], many["to"]))
+
 
+# Course/placement keys are interned: every parsed course carries its own
+# copy of its code, and the model-building dicts compare these keys on each
+# lookup. Interned, equal keys are the same object and compare by identity.
 
 def course_id(course: dict, use_seasons: bool = False) -> str:
     code = course["codes"][0]
     if use_seasons:
         season = course["season_codes"][0] if course.get("season_codes") else "NA"
-        return f"{code}@{season}"
+        return sys.intern(f"{code}@{season}")
     else:
-        return code
+        return sys.intern(code)
 
 
 def base_key(course: dict) -> str:
-    return course["codes"][0]
-
-
-def q_bounds(q):
-        if "Single" in q:
-            n = int(q["Single"])
-            return n, n
-        return int(q["Many"]["from"]), int(q["Many"]["to"])
+    return sys.intern(course["codes"][0])
 
 
 def is_placement(obj):
     """Example: `{'filled': False, 'id': '5fc3660b-54ff-47c4-bff2-0e50db5d60b5', 'description': 'Equivalent Placement or Credit'}`"""
-    return isinstance(obj, dict) and "id" in obj and "filled" in obj and "description" in obj
+    return type(obj) is dict and "id" in obj and "filled" in obj and "description" in obj
 
 
-def placement_key(p): 
-    return f"PLACEMENT:{p['id']}"
+def as_groups(groups: list) -> list[list]:
+    """Normalize a list of groups: a bare course/placement dict means a singleton group."""
+    return [g if isinstance(g, list) else [g] for g in groups]
 
 
-def is_place_key(k: str) -> bool:
-    return k.startswith("PLACEMENT:")
+def placement_key(p): 
+    return sys.intern(f"PLACEMENT:{p['id']}")
 
 
 # ---------- CP-SAT model ----------
+#
+# The model is written straight into the underlying `CpModelProto` instead of
+# going through `new_bool_var` / `add` / `only_enforce_if`. Every wrapper call
+# crosses pybind11 and type-checks its arguments, which dominates build time
+# once there are thousands of (requirement, candidate) pairs. Variables are
+# plain integer indices into `proto.variables`; `~v` (i.e. `-v - 1`) is the
+# negated literal, as in the proto spec.
+
+# CP-SAT only needs variable names for debugging (model dumps, logs), so
+# they are only built when this is set.
+DEBUG = False
+_NAME_XLATE = str.maketrans({" ": "_", "@": "_", ":": "_"})
+
+
+def var_name(prefix: str, key: str) -> str:
+    return f"{prefix}_{key.translate(_NAME_XLATE)}"
+
+
+def new_bools(proto, count: int, names: list[str] | None = None) -> range:
+    """Append `count` boolean vars (named if `names` is given) in one batch; returns their indices."""
+    variables = proto.variables
+    start = len(variables)
+    for i in range(count):
+        var = variables.add()
+        if names is not None:
+            var.name = names[i]
+        var.domain.extend((0, 1))
+    return range(start, len(variables))
+
+
+def add_linear(proto, vars_, coeffs, lo: int, hi: int, enforce: int | None = None) -> None:
+    """`lo <= sum(coeffs[i] * vars_[i]) <= hi`, optionally only if literal `enforce` holds."""
+    ct = proto.constraints.add()
+    if enforce is not None:
+        ct.enforcement_literal.append(enforce)
+    ct.linear.vars.extend(vars_)
+    ct.linear.coeffs.extend(coeffs)
+    ct.linear.domain.extend((lo, hi))
+
+
+def sum_terms(vars_: list[int]) -> tuple[list[int], list[int]]:
+    """(vars, coeffs) of `sum(vars_)`, with repeated vars merged into one term."""
+    if len(set(vars_)) == len(vars_):
+        return vars_, [1] * len(vars_)
+    terms: dict[int, int] = {}
+    for v in vars_:
+        terms[v] = terms.get(v, 0) + 1
+    return list(terms), list(terms.values())
+
+
+def set_maximize(proto, vars_: list[int], coeffs: list[int]) -> None:
+    """Replace the objective with `maximize sum(coeffs[i] * vars_[i])`."""
+    # CpModelProto only minimizes; maximize by negating and flipping the scale.
+    proto.clear_objective()
+    proto.objective.vars.extend(vars_)
+    proto.objective.coeffs.extend([-c for c in coeffs])
+    proto.objective.scaling_factor = -1
+
+
+def set_hint(proto, solution) -> None:
+    proto.clear_solution_hint()
+    proto.solution_hint.vars.extend(range(len(solution)))
+    proto.solution_hint.values.extend(solution)
+
+
+def add_count(proto, vars_: list[int], lo: int, hi: int, enforce: int | None = None) -> None:
+    """`lo <= sum(vars_) <= hi`."""
+    add_linear(proto, *sum_terms(vars_), lo, hi, enforce)
+
+
+# One solver for every object in the stream; solver setup and worker thread
+# spin-up otherwise dominate the solve time of small models.
+SOLVER = cp_model.CpSolver()
+SMALL_MODEL_VARS = 2000
+
+# Upper bound on CP-SAT workers per solve. Pool processes lower it to 1:
+# they already run one object per core, and internal workers would only
+# compete with them.
+MAX_SEARCH_WORKERS = 8
+
+
+def single_worker_solves() -> None:
+    global MAX_SEARCH_WORKERS
+    MAX_SEARCH_WORKERS = 1
+
+
+def tune_solver(solver: cp_model.CpSolver, num_vars: int) -> None:
+    params = solver.parameters
+    params.stop_after_first_solution = False
+    params.relative_gap_limit = 0.0
+    if num_vars < SMALL_MODEL_VARS:
+        # Extra workers and presolve cost more than they save on small,
+        # mostly-boolean models. The LP relaxation and probing stay on: without
+        # them the fill stage rarely proves optimality within its time slice.
+        params.num_search_workers = 1
+        params.cp_model_presolve = False
+    else:
+        params.num_search_workers = MAX_SEARCH_WORKERS
+        params.cp_model_presolve = True
+
 
-def solve_no_double_count(matching_eval, include_query: bool = False):
+def greedy_fill(groups: list[dict], key_base: dict[str, str | None], qmax: int) -> set[str]:
     """
-    ## Classes are not double counted
-    
-    Classes are consumed by each constraint.
-    
-    ## Fills the most important priorities first (non-negotiable)
-    
-    Eg.
-    ```mql
-    @1 -- SELECT 2 FROM [SELECT 1 FROM CLASS(MATH 2250), SELECT 1 FROM CLASS(MATH 2260)] : "must take a linear algebra" : 1;
-    @2 -- SELECT 1 FROM CLASS(MATH 2260) : "must take a hard linear algebra" : 2;
-    ```
-    
-    will partially fill MATH 2250 for @1 (failing) and MATH 2260 for @2 (passing).
-    
-    ## 
+    Best fill of one requirement whose candidates are shared with nobody:
+    at most `qmax` keys and at most `limit` per group, real courses before placements.
+    """
+    courses: list[str] = []
+    spare_placements: list[str] = []  # placements that still fit in their group
+    for group in groups:
+        taken = [k for k in group["keys"] if key_base[k] is not None][:group["limit"]]
+        courses.extend(taken)
+        spare_placements.extend(
+            [k for k in group["keys"] if key_base[k] is None][:group["limit"] - len(taken)]
+        )
+    return set((courses + spare_placements)[:qmax])
+
+
+def format_solution(
+    results,
+    offerings: dict[str, dict],
+    placements: dict[str, dict],
+    req_cands: list[list[str]],
+    chosen: list[set[str]],
+    satisfied: list[bool],
+    status: str,
+    include_query: bool,
+):
+    used = set().union(*chosen)
+    selected_courses = [c for c in offerings if c in used]
+    selected_placements = [pk for pk in placements if pk in used]
+
+    per_req = []
+    for r, qr in enumerate(results):
+        per_req_item = {
+            "description": qr["requirement"]["description"],
+            "priority": qr["requirement"]["priority"],
+            "satisfied": satisfied[r],
+            "selected": [k for k in req_cands[r] if k in chosen[r]],  # contains course ids and "PLACEMENT:<id>" keys
+        }
+        
+        if include_query:
+            per_req_item["query"] = qr["requirement"]["query"]
+        
+        per_req.append(per_req_item)
+
+    return {
+        "status": "ok",
+        "status_cpsat": status,
+        "total_satisfied": sum(satisfied),
+        "total_courses": len(selected_courses),  # NOTE: this is only courses, not placements
+        "selected_courses": selected_courses,
+        "selected_placements": selected_placements,
+        "per_requirement": per_req,
+    }
+
+
+def collect_candidates(matching_eval, use_seasons: bool, support_placements: bool):
+    """
+    Keys every course/placement in `matching_eval` and lists each requirement's candidates.
+
+    Returns `(offerings, placements, key_base, req_bounds, req_cands, req_groups)`.
     """
-    model = cp_model.CpModel()
     results = matching_eval["results"]
     
     # ---------- Collect all offerings ----------
     offerings: dict[str, dict] = {}    # course_id -> course dict
     placements: dict[str, dict] = {}   # placement_key -> placement dict
 
-    x: dict[str, cp_model.IntVar] = {}       # course offer selection vars
-    x_place: dict[str, cp_model.IntVar] = {} # placement selection vars
-    
-    # for item in matching_eval.get("allSelectedCourses", []):
-    for item in [c for group in matching_eval.get("allSelectedCourses", []) for c in (group if isinstance(group, list) else [group])]:
+    # Per-item and per-key facts, computed once instead of at every use.
+    item_key: dict[int, str] = {}         # id(item) -> course-id OR placement-key
+    key_base: dict[str, str | None] = {}  # key -> base course (None for placements)
+
+    def register(item) -> str:
+        key = item_key.get(id(item))
+        if key is not None:
+            return key
         if is_placement(item):
-            pk = placement_key(item)
-            if pk not in x_place:
-                placements[pk] = item
-                x_place[pk] = model.new_bool_var(f"x_{pk.replace(':','_')}")
+            key = placement_key(item)
+            if key not in placements:
+                placements[key] = item
+                key_base[key] = None
         else:
-            cid = course_id(item)
-            if cid not in x:
-                offerings[cid] = item
-                x[cid] = model.new_bool_var(f"x_{cid.replace(' ','_').replace('@','_')}")
+            key = course_id(item, use_seasons)
+            if key not in offerings:
+                offerings[key] = item
+                key_base[key] = base_key(item)
+        item_key[id(item)] = key
+        return key
+
+    def usable(item) -> bool:
+        return support_placements or not is_placement(item)
+    
+    for item in itertools.chain.from_iterable(as_groups(matching_eval.get("allSelectedCourses", []))):
+        if usable(item):
+            register(item)
 
-    # Assignment vars: y[r,key] where key is course-id OR placement-key
-    y: dict[tuple[int, str], cp_model.IntVar] = {}
+    # ---------- Candidates per requirement ----------
+    req_bounds: list[tuple[int, int]] = []
     req_cands: list[list[str]] = []
-    sat: list[cp_model.IntVar] = []
+    req_groups: list[list[dict]] = []  # [{"limit": int, "keys": [...]}, ...]
 
-    for r, qr in enumerate(results):
+    for qr in results:
         req = qr["requirement"]
-        qmin, qmax = q_bounds(req["query"]["quantity"])
+        req_bounds.append(q_bounds(req["query"]["quantity"]))
 
         cand_keys: list[str] = []
-        groups: list[dict] = []  # {"limit": int, "keys": [...]}
+        groups: list[dict] = []
+
+        selector = req["query"].get("selector", [])
 
         # Build candidate keys (courses + placements)
         # selectedCourses is a list of groups (each group is a list of courses/placements)
         # each group corresponds to one inner SELECT node in the query selector
-        for group_idx, group_items in enumerate(qr["selectedCourses"]):
-            # normalize: a bare course/placement dict means a singleton group
-            if not isinstance(group_items, list):
-                group_items = [group_items]
-
+        for group_idx, group_items in enumerate(as_groups(qr["selectedCourses"])):
             # get the limit for this group from the query selector
-            selector = req["query"].get("selector", [])
             if group_idx < len(selector):
                 inner_query = selector[group_idx].get("Query", {})
                 _, glimit = q_bounds(inner_query.get("quantity", {"Single": len(group_items)}))
             else:
                 glimit = len(group_items)  # uncapped fallback
 
-            group_keys: list[str] = []
-            for item in group_items:
-                if is_placement(item):
-                    pk = placement_key(item)
-                    cand_keys.append(pk)
-                    group_keys.append(pk)
-                    if pk not in x_place:
-                        placements[pk] = item
-                        x_place[pk] = model.new_bool_var(f"x_{pk.replace(':','_')}")
-                else:
-                    cid = course_id(item)
-                    cand_keys.append(cid)
-                    group_keys.append(cid)
-                    if cid not in x:
-                        offerings[cid] = item
-                        x[cid] = model.new_bool_var(f"x_{cid.replace(' ','_').replace('@','_')}")
+            group_keys = [register(item) for item in group_items if usable(item)]
+            cand_keys.extend(group_keys)
 
             if group_keys:
                 groups.append({"limit": glimit, "keys": group_keys})
 
         req_cands.append(cand_keys)
+        req_groups.append(groups)
+
+    return offerings, placements, key_base, req_bounds, req_cands, req_groups
+
+
+def build_model(
+    proto,
+    results,
+    placements: dict[str, dict],
+    key_base: dict[str, str | None],
+    req_bounds: list[tuple[int, int]],
+    req_cands: list[list[str]],
+    req_groups: list[list[dict]],
+):
+    """
+    Writes the variables and constraints into `proto`.
 
-        # Create y vars and link to selection vars
-        for key in cand_keys:
-            y[(r, key)] = model.new_bool_var(
-                f"y_r{r}_{key.replace(' ','_').replace('@','_').replace(':','_')}"
-            )
-            if is_place_key(key):
-                model.add(y[(r, key)] <= x_place[key])
+    Returns `(x_place, y_keys, y_vars, sat)`.
+    """
+    # Courses get no selection var of their own: base-course uniqueness lets
+    # at most one y use a course, so "selected" is just "some y of it is set".
+    # placement selection vars (for the placement penalty)
+    x_place: dict[str, int] = dict(
+        zip(placements, new_bools(
+            proto, len(placements), [var_name("x", pk) for pk in placements] if DEBUG else None
+        ))
+    )
+
+    # Assignment vars, one per distinct candidate of each requirement:
+    # y_vars[r][i] assigns y_keys[r][i] (course-id OR placement-key) to r
+    y_vars: list[list[int]] = [[] for _ in results]
+    y_keys: list[list[str]] = [[] for _ in results]
+    sat: list[int] = [0] * len(results)
+
+    # every y that would consume a base course / a placement
+    base_to_y: dict[str, list[int]] = {}
+    place_to_y: dict[str, list[int]] = {}
+
+    # Most constrained first: requirements with the fewest candidates create
+    # their vars (and so come first in CP-SAT's default ordering) first.
+    # Everything stays indexed by the original r.
+    order = sorted(range(len(results)), key=lambda r: len(req_cands[r]))
+
+    # Create every y and sat var in one batch, requirement by requirement.
+    names: list[str] | None = [] if DEBUG else None
+    for r in order:
+        y_keys[r] = list(dict.fromkeys(req_cands[r]))
+        if names is not None:
+            names.extend([var_name(f"y_r{r}", key) for key in y_keys[r]])
+            names.append(f"sat_{r}")
+    count = sum(len(y_keys[r]) + 1 for r in order)
+    new_vars = iter(new_bools(proto, count, names))
+    for r in order:
+        y_vars[r] = list(itertools.islice(new_vars, len(y_keys[r])))
+        sat[r] = next(new_vars)
+
+    for r in order:
+        qmin, qmax = req_bounds[r]
+        cand_keys = req_cands[r]
+
+        # Link y vars to selection vars
+        var_of = dict(zip(y_keys[r], y_vars[r]))
+        for key, yv in var_of.items():
+            b = key_base[key]
+            if b is None:
+                # y <= x_place
+                add_linear(proto, (yv, x_place[key]), (1, -1), INT_MIN, 0)
+                place_to_y.setdefault(key, []).append(yv)
             else:
-                model.add(y[(r, key)] <= x[key])
+                base_to_y.setdefault(b, []).append(yv)
 
-        sum_assigned = sum(y[(r, key)] for key in cand_keys)
+        assigned = sum_terms([var_of[key] for key in cand_keys])
 
-        s = model.new_bool_var(f"sat_{r}")
-        sat.append(s)
+        s = sat[r]
 
         # Allow partial fills when unsatisfied:
-        model.add(sum_assigned <= qmax)  # unconditional cap
-        model.add(sum_assigned >= qmin).only_enforce_if(s)
+        add_linear(proto, *assigned, INT_MIN, qmax)  # unconditional cap
+        add_linear(proto, *assigned, qmin, INT_MAX, enforce=s)
         if qmin > 0:
-            model.add(sum_assigned <= qmin - 1).only_enforce_if(s.negated())
+            add_linear(proto, *assigned, INT_MIN, qmin - 1, enforce=~s)
         else:
-            model.add(sum_assigned == 0).only_enforce_if(s.negated())
+            add_linear(proto, *assigned, 0, 0, enforce=~s)
             
-        for group in groups:
-            gkeys = [k for k in group["keys"] if (r, k) in y]
-            if gkeys:
-                model.add(sum(y[(r, k)] for k in gkeys) <= group["limit"])
-
-    # ---------- NO DOUBLE COUNTING (offering-level + placement-level) ----------
-    # each course offering can satisfy at most one requirement
-    for c in list(x.keys()):
-        used_by = [y[(r, c)] for r in range(len(results)) if (r, c) in y]
-        if used_by:
-            model.add(sum(used_by) <= 1)
+        # every group key got its y var above
+        for group in req_groups[r]:
+            add_count(proto, [var_of[k] for k in group["keys"]], INT_MIN, group["limit"])
+
+    # ---------- NO DOUBLE COUNTING (base-level + placement-level) ----------
+    # Each course offering can satisfy at most one requirement. Every offering
+    # maps to exactly one base course, so its y vars are a subset of that
+    # base's and the base-course uniqueness below already implies it.
 
     # each placement checkbox can satisfy at most one requirement
-    for pk in list(x_place.keys()):
-        used_by = [y[(r, pk)] for r in range(len(results)) if (r, pk) in y]
-        if used_by:
-            model.add(sum(used_by) <= 1)
+    for used_by in place_to_y.values():
+        add_count(proto, used_by, INT_MIN, 1)
 
     # ---------- Base-course uniqueness (skip placements) ----------
-    base_to_y: dict[str, list[cp_model.IntVar]] = {}
+    for b, vars_ in base_to_y.items():
+        add_count(proto, vars_, INT_MIN, 1)
+
+    # Branch on sat vars first: highest priority, then tightest, set to true.
+    strategy = proto.search_strategy.add()
+    strategy.variables.extend(
+        sat[r] for r in sorted(order, key=lambda r: -results[r]["requirement"]["priority"])
+    )
+    strategy.variable_selection_strategy = cp_model.CHOOSE_FIRST
+    strategy.domain_reduction_strategy = cp_model.SELECT_MAX_VALUE
+
+    return x_place, y_keys, y_vars, sat
+
+
+def objective_stages(
+    results,
+    x_place: dict[str, int],
+    y_vars: list[list[int]],
+    sat: list[int],
+    priority_lex: bool,
+) -> list[tuple[list[int], list[int]]]:
+    """
+    The (vars, coeffs) of each objective to maximize, in order.
 
-    for (r, key), var in y.items():
-        if is_place_key(key):
-            continue
-        course = offerings[key]
-        b = base_key(course)
-        base_to_y.setdefault(b, []).append(var)
+    Solved lexicographically instead of as one weighted sum (whose tier
+    coefficients grow as (R+1)**tiers): maximize the satisfied requirements
+    of the top tier, pin that count as a floor, move on to the next tier, and finally
+    maximize the fills. Without `priority_lex` all requirements form one tier.
+    """
+    tiers: dict[int, list[int]] = {}  # priority -> sat vars of that tier
+    for r, qr in enumerate(results):
+        p = qr["requirement"]["priority"] if priority_lex else 0
+        tiers.setdefault(p, []).append(sat[r])
 
-    for b, vars_ in base_to_y.items():
-        model.add(sum(vars_) <= 1)
+    # Tie-breaker: maximize assigned items (courses + placements).
+    # Optional: discourage placements slightly so the solver prefers real courses when possible.
+    PLACEMENT_PENALTY = 1
 
-    # ---------- Objective (priority-lexicographic + best-effort fills) ----------
-    total_satisfied = sum(sat)
-    total_courses = sum(x.values())  # NOTE: this is only courses, not placements
+    stages: list[tuple[list[int], list[int]]] = []
+    for p in sorted(tiers, reverse=True):
+        stages.append((tiers[p], [1] * len(tiers[p])))
+    all_y = list(itertools.chain.from_iterable(y_vars))
+    stages.append((
+        [*all_y, *x_place.values()],
+        [*[1] * len(all_y), *[-PLACEMENT_PENALTY] * len(x_place)],
+    ))
+    return stages
 
-    R = len(results)
-    req_priority = [results[r]["requirement"]["priority"] for r in range(R)]
-    priorities = sorted(set(req_priority), reverse=True)
 
-    BASE = R + 1
-    expr = 0
-    for i, p in enumerate(priorities):
-        tier_sat = sum(sat[r] for r in range(R) if req_priority[r] == p)
-        expr += tier_sat * (BASE ** (len(priorities) - 1 - i))
+def solve_stages(model: cp_model.CpModel, stages: list[tuple[list[int], list[int]]]):
+    """
+    Maximizes each stage in turn, keeping earlier optima as lower bounds.
+    Each stage is hinted with the previous solution.
 
-    M = 10_000
+    Returns `(status, solution)`. If a later stage finds nothing in its time
+    slice, the last stage's solution (still feasible) is returned with its
+    status; `solution` is None only if the first stage found nothing.
+    """
+    proto = model.proto
+    solver = SOLVER
+    tune_solver(solver, len(proto.variables))
+    solver.parameters.max_time_in_seconds = 2.0 / len(stages)
+
+    status, value = None, None
+    for i, (vars_, coeffs) in enumerate(stages):
+        set_maximize(proto, vars_, coeffs)
+        stage_status = solver.Solve(model)
+
+        if stage_status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            if value is None:
+                return stage_status, None
+            return status, value
+
+        status = stage_status
+        value = list(solver.response_proto.solution)
+        if i < len(stages) - 1:
+            best = sum(c * value[v] for v, c in zip(vars_, coeffs))
+            add_linear(proto, vars_, coeffs, best, INT_MAX)
+            set_hint(proto, value)
+
+    return status, value
+
+
+def solve_no_double_count(
+    matching_eval,
+    *,
+    use_seasons: bool = False,
+    priority_lex: bool = True,
+    support_placements: bool = True,
+    include_query: bool = False,
+):
+    """
+    ## Classes are not double counted
+    
+    Classes are consumed by each constraint.
+    
+    ## Fills the most important priorities first (non-negotiable)
+    
+    Eg.
+    ```mql
+    @1 -- SELECT 2 FROM [SELECT 1 FROM CLASS(MATH 2250), SELECT 1 FROM CLASS(MATH 2260)] : "must take a linear algebra" : 1;
+    @2 -- SELECT 1 FROM CLASS(MATH 2260) : "must take a hard linear algebra" : 2;
+    ```
+    
+    will partially fill MATH 2250 for @1 (failing) and MATH 2260 for @2 (passing).
+    
+    ## Options
 
-    # Tie-breaker: maximize assigned items (courses + placements).
-    # Optional: discourage placements slightly so the solver prefers real courses when possible.
-    PLACEMENT_PENALTY = 1
-    model.maximize(expr * M + sum(y.values()) - PLACEMENT_PENALTY * sum(x_place.values()))
+    - `use_seasons`: key offerings by course and season (still one per base course).
+    - `priority_lex`: fill priority tiers lexicographically; otherwise all tiers weigh the same.
+    - `support_placements`: let placement/credit checkboxes count toward requirements.
+    - `include_query`: echo each requirement's query in the output.
+    """
+    results = matching_eval["results"]
+    offerings, placements, key_base, req_bounds, req_cands, req_groups = collect_candidates(
+        matching_eval, use_seasons, support_placements
+    )
+
+    # ---------- Decomposable instances (no CP-SAT) ----------
+    # When no base course or placement is a candidate more than once (within
+    # one requirement or across requirements), the no-double-count coupling
+    # is vacuous: every requirement is filled on its own, greedily.
+    units = Counter(key_base[k] or k for cands in req_cands for k in cands)
+    if all(n == 1 for n in units.values()):
+        chosen = [greedy_fill(req_groups[r], key_base, req_bounds[r][1]) for r in range(len(results))]
+        satisfied = [len(chosen[r]) >= req_bounds[r][0] for r in range(len(results))]
+        return format_solution(
+            results, offerings, placements, req_cands, chosen, satisfied, "greedy", include_query
+        )
+
+    # ---------- CP-SAT model ----------
+    model = cp_model.CpModel()
+    x_place, y_keys, y_vars, sat = build_model(
+        model.proto, results, placements, key_base, req_bounds, req_cands, req_groups
+    )
 
-    solver = cp_model.CpSolver()
-    solver.parameters.max_time_in_seconds = 2.0
-    solver.parameters.num_search_workers = 8
-    status = solver.Solve(model)
+    # ---------- Objective (priority-lexicographic + best-effort fills) ----------
+    stages = objective_stages(results, x_place, y_vars, sat, priority_lex)
+    status, value = solve_stages(model, stages)
 
-    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+    if value is None:
         return {"status": "no_solution", "status_cpsat": str(status)}
 
-    selected_courses = [c for c, var in x.items() if solver.value(var) == 1]
-    selected_placements = [pk for pk, var in x_place.items() if solver.value(var) == 1]
+    return format_solution(
+        results,
+        offerings,
+        placements,
+        req_cands,
+        [
+            {k for k, v in zip(y_keys[r], y_vars[r]) if value[v] == 1}
+            for r in range(len(results))
+        ],
+        [value[sat[r]] == 1 for r in range(len(results))],
+        str(status),
+        include_query,
+    )
+    
 
-    per_req = []
-    for r, qr in enumerate(results):
-        chosen = [k for k in req_cands[r] if solver.value(y[(r, k)]) == 1]
+class TeeReader:
+    """Reads from `raw`, writing a copy of every byte handed out to the file `copy`."""
 
-        per_req_item = {
-            "description": qr["requirement"]["description"],
-            "priority": qr["requirement"]["priority"],
-            "satisfied": solver.value(sat[r]) == 1,
-            "selected": chosen,  # contains course ids and "PLACEMENT:<id>" keys
-        }
-        
-        if include_query:
-            per_req_item["query"] = qr["requirement"]["query"]
-        
-        per_req.append(per_req_item)
+    def __init__(self, raw, copy):
+        self.raw = raw
+        self.copy = copy
 
-    
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.copy.write(data)
+        return data
 
-    return {
-        "status": "ok",
-        "status_cpsat": str(status),
-        "total_satisfied": solver.value(total_satisfied),
-        "total_courses": solver.value(total_courses),
-        "selected_courses": selected_courses,
-        "selected_placements": selected_placements,
-        "per_requirement": per_req,
-    }
-    
 
 SCRIPT_LOCATION = Path(__file__).resolve()
 INPUT_LOCATION = SCRIPT_LOCATION.parent.parent / "inputs" / "test"
 
 
 if __name__ == "__main__":
-    try:
-        compiled_mql = subprocess.run(
-            ["mql", f"{INPUT_LOCATION / "test.mql" }"],
-            capture_output=True,
-            check=True,
-            text=True,
+    # `mql | npm run dev`: npm (and its `tsc` step) starts right away and
+    # reads the compiled MQL straight from the pipe instead of waiting for
+    # `mql` to finish and having it round-trip through this process.
+    mql_out, npm_in = os.pipe()
+    # stdout is parsed as it streams; stderr goes to a file so that npm can
+    # never block on a full stderr pipe while stdout is being read
+    match_err_file = tempfile.TemporaryFile()
+    matcher = subprocess.Popen(
+        ["npm", "run", "dev", "--silent"],
+        stdin=mql_out,
+        stdout=subprocess.PIPE,
+        stderr=match_err_file,
+    )
+    compiler = subprocess.Popen(
+        ["mql", str(INPUT_LOCATION / "test.mql")],
+        stdout=npm_in,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    # the children hold their own copies of the pipe ends
+    os.close(mql_out)
+    os.close(npm_in)
+
+    _, compile_err = compiler.communicate()
+    if compiler.returncode != 0:
+        print(f"Compilation failed with exit code {compiler.returncode}", file=sys.stderr)
+        print(f"Error output (stderr): {compile_err}", file=sys.stderr)
+        # If npm already failed (e.g. `tsc` errors) it stopped reading stdin
+        # and `mql` merely died on the broken pipe; then the matcher's failure
+        # below is the real one. npm holds the pipe's read end until it exits,
+        # so by now it has exited in that case.
+        broken_pipe = (
+            compiler.returncode == -signal.SIGPIPE
+            or "EPIPE" in compile_err
+            or "Broken pipe" in compile_err
         )
-    except subprocess.CalledProcessError as e:
-        print(f"Compilation failed with exit code {e.returncode}", file=sys.stderr)
-        print(f"Error output (stderr): {e.stderr}", file=sys.stderr)
-        exit(1)
-    
-    print("Compiled MQL")
-    
-    try:
-        result = subprocess.run(
-            ["npm", "run", "dev", "--silent"],
-            check=True,
-            input=compiled_mql.stdout,
-            text=True,
-            capture_output=True,
-        )
-    except subprocess.CalledProcessError as e:
-        print(e.stdout)
-        print(f"Matching failed with exit code {e.returncode}", file=sys.stderr)
-        print(f"Error output (stderr): {e.stderr}", file=sys.stderr)
-        exit(2)
-
-    print("Found required courses")
+        if not broken_pipe or matcher.poll() in (None, 0):
+            matcher.kill()
+            matcher.wait()
+            exit(1)
+    else:
+        print("Compiled MQL")
     
-    for object in json.loads(result.stdout):
-        # print(json.dumps(object, indent=2))
-        sol = solve_no_double_count(object)
-        print(json.dumps(sol, indent=2))
\ No newline at end of file
+    # objects are independent; solve them side by side, one per core
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=single_worker_solves) as pool:
+        # The matcher prints one JSON array; hand each element to the pool as
+        # soon as it is parsed instead of buffering the whole array first.
+        futures = []
+        parse_error = None
+        # keep a copy of the output on disk (not in memory) to print on failure
+        match_out_file = tempfile.TemporaryFile()
+        match_out = TeeReader(matcher.stdout, match_out_file)
+        try:
+            for object in ijson.items(match_out, "item", use_float=True):
+                futures.append(pool.submit(solve_no_double_count, object))
+        except ijson.JSONError as e:
+            parse_error = e
+
+        match_out.read()  # whatever ijson did not get to
+        matcher.wait()
+        match_err_file.seek(0)
+        match_err = match_err_file.read().decode()
+        if matcher.returncode != 0 or parse_error is not None:
+            pool.shutdown(cancel_futures=True)
+            match_out_file.seek(0)
+            print(match_out_file.read().decode(errors="replace"))
+            if matcher.returncode == 0:
+                print(f"Could not parse matcher output: {parse_error}", file=sys.stderr)
+            print(f"Matching failed with exit code {matcher.returncode}", file=sys.stderr)
+            print(f"Error output (stderr): {match_err}", file=sys.stderr)
+            exit(2)
+
+        print("Found required courses")
+
+        for future in as_completed(futures):
+            print(orjson.dumps(future.result(), option=orjson.OPT_INDENT_2).decode())